@@ -2,11 +2,21 @@
 import os
 import sys
 import time
+import queue
+import threading
 import argparse
+import shlex
 import subprocess
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from requests_toolbelt.multipart.encoder import MultipartEncoder
 import re
 import shutil
+import hashlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from datetime import datetime, timezone
 
 # Visual Constants
@@ -18,6 +28,10 @@ RED = "\033[31m"
 
 ROOT_DIRECTORY = os.getcwd()
 
+# Precompiled Patterns
+_PROG_RE = re.compile(rb'(\d+%) (\d+/\d+)')
+_ANDROID_RE = re.compile(rb'(?<=android-)[0-9]+')
+
 # Attempt to detect ROM name from directory
 try:
     ROM_NAME = os.path.basename(ROOT_DIRECTORY)
@@ -26,14 +40,16 @@ except:
 
 # Detect Android version from manifest
 try:
-    with open(".repo/manifests/default.xml", "r") as f:
-        content = f.read()
-        match = re.search(r'(?<=android-)[0-9]+', content)
-        ANDROID_VERSION = match.group(0) if match else "Unknown"
+    # The android-N revision sits in the manifest header, no need to read it all
+    with open(".repo/manifests/default.xml", "rb") as f:
+        match = _ANDROID_RE.search(f.read(8192))
+        ANDROID_VERSION = match.group(0).decode() if match else "Unknown"
 except FileNotFoundError:
     ANDROID_VERSION = "Unknown"
 
 # Config Loader
+_BOOLS = {'true': True, 'false': False}
+
 def load_env(file_path):
     config = {}
     if not os.path.exists(file_path):
@@ -41,20 +57,15 @@ def load_env(file_path):
         sys.exit(1)
 
     with open(file_path, 'r') as f:
-        for line in f:
-            if line.strip().startswith('#') or not line.strip():
+        for raw in f:
+            line = raw.strip()
+            if not line or line[0] == '#':
                 continue
-            if '=' in line:
-                key, value = line.split('=', 1)
-                key = key.strip()
-                value = value.strip().strip('"').strip("'")
-
-                if value.lower() == 'true':
-                    value = True
-                elif value.lower() == 'false':
-                    value = False
-
-                config[key] = value
+            key, sep, value = line.partition('=')
+            if not sep:
+                continue
+            value = value.strip().strip('"').strip("'")
+            config[key.strip()] = _BOOLS.get(value.lower(), value)
     return config
 
 # Telegram Bot Class
@@ -63,6 +74,14 @@ class CIBot:
         self.config = config
         self.base_url = f"https://api.telegram.org/bot{config['BOT_TOKEN']}"
         self.message_id = None
+        self.session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset(["GET", "POST"]))
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=4)
+        self.session.mount("https://", adapter)
+        # Streamed upload bodies cannot be replayed, so only retry failed connects
+        self.upload_session = requests.Session()
+        self.upload_session.mount("https://", HTTPAdapter(max_retries=3))
 
     def send_message(self, text, chat_id=None):
         target_chat = chat_id if chat_id else self.config['CHAT_ID']
@@ -74,7 +93,7 @@ class CIBot:
             "disable_web_page_preview": True
         }
         try:
-            r = requests.post(url, data=data)
+            r = self.session.post(url, data=data, timeout=(5, 30))
             response = r.json()
             if response.get("ok"):
                 return response["result"]["message_id"]
@@ -97,21 +116,24 @@ class CIBot:
             "disable_web_page_preview": True
         }
         try:
-            requests.post(url, data=data)
+            r = self.session.post(url, data=data, timeout=(5, 30))
+            return r.ok
         except Exception as e:
             print(f"{RED}Failed to edit message: {e}{RESET}")
+        return False
 
     def send_document(self, file_path, chat_id=None):
         target_chat = chat_id if chat_id else self.config['CHAT_ID']
         url = f"{self.base_url}/sendDocument"
-        data = {
-            "chat_id": target_chat,
-            "parse_mode": "html",
-            "disable_web_page_preview": True
-        }
         try:
             with open(file_path, 'rb') as f:
-                requests.post(url, data=data, files={"document": f})
+                m = MultipartEncoder(fields={
+                    "chat_id": str(target_chat),
+                    "parse_mode": "html",
+                    "disable_web_page_preview": "true",
+                    "document": (os.path.basename(file_path), f, "application/octet-stream")
+                })
+                self.upload_session.post(url, data=m, headers={"Content-Type": m.content_type}, timeout=(5, 30))
         except Exception as e:
             print(f"{RED}Failed to upload file: {e}{RESET}")
 
@@ -120,17 +142,26 @@ class CIBot:
         url = f"{self.base_url}/pinChatMessage"
         data = {"chat_id": target_chat, "message_id": message_id}
         try:
-            requests.post(url, data=data)
+            self.session.post(url, data=data, timeout=(5, 30))
         except Exception as e:
             print(f"{RED}Could not pin message: {e}{RESET}")
 
 # Helper Functions
+_GOFILE_SESSION = requests.Session()
+# Streamed upload bodies cannot be replayed, so only retry failed connects
+_GOFILE_SESSION.mount("https://", HTTPAdapter(max_retries=3))
+
 def upload_gofile(file_path):
     try:
         with open(file_path, 'rb') as f:
-            upload_req = requests.post(
+            m = MultipartEncoder(fields={
+                'file': (os.path.basename(file_path), f, 'application/octet-stream')
+            })
+            upload_req = _GOFILE_SESSION.post(
                 'https://upload.gofile.io/uploadfile',
-                files={'file': f}
+                data=m,
+                headers={'Content-Type': m.content_type},
+                timeout=(5, 300)
             )
         resp = upload_req.json()
         if resp['status'] == 'ok':
@@ -142,7 +173,8 @@ def upload_gofile(file_path):
 
 def upload_rclone(file_path, remote, folder):
     try:
-        cmd = ["rclone", "copy", file_path, f"{remote}:{folder}"]
+        cmd = ["rclone", "copy", "--transfers=16", "--checkers=32", "--multi-thread-streams=8",
+               "--fast-list", file_path, f"{remote}:{folder}"]
         subprocess.run(cmd, check=True)
 
         cmd_link = ["rclone", "link", f"{remote}:{folder}/{os.path.basename(file_path)}"]
@@ -151,22 +183,50 @@ def upload_rclone(file_path, remote, folder):
     except subprocess.CalledProcessError:
         return "Rclone Upload Failed"
 
-def fetch_progress(log_file):
-    try:
-        if not os.path.exists(log_file):
-            return None
-
-        with open(log_file, "r") as f:
-            lines = f.readlines()
-
-        for line in reversed(lines):
-            if "ninja" in line or "%" in line:
-                match = re.search(r'(\d+%) (\d+/\d+)', line)
-                if match:
-                    return f"{match.group(1)} ({match.group(2)})"
-    except Exception:
-        pass
-    return "Initializing..."
+def tail_progress(log_file, stop_event, updates):
+    pos = 0
+    while not stop_event.is_set():
+        try:
+            with open(log_file, "rb") as f:
+                f.seek(pos)
+                while True:
+                    line = f.readline()
+                    # Leave partially written lines for the next pass
+                    if not line.endswith(b"\n"):
+                        break
+                    pos = f.tell()
+                    if b"ninja" in line or b"%" in line:
+                        match = _PROG_RE.search(line)
+                        if match:
+                            updates.put(f"{match.group(1).decode()} ({match.group(2).decode()})")
+        except Exception:
+            pass
+        stop_event.wait(1)
+
+def tail_contains(file_path, needle, window=65536):
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        f.seek(max(0, size - window))
+        return needle in f.read().decode("utf-8", errors="ignore")
+
+def list_device_zips(out_dir, device):
+    with os.scandir(out_dir) as it:
+        return [(e.name, e.stat().st_size) for e in it
+                if e.is_file() and device in e.name and e.name.endswith(".zip")]
+
+def md5sum(file_path):
+    h = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def format_size(size):
+    for unit in ["B", "K", "M", "G"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
 
 def format_duration(seconds):
     minutes, seconds = divmod(seconds, 60)
@@ -194,6 +254,12 @@ def main():
             print(f"{RED}\nERROR: Missing {key} in config file. Exiting...{RESET}\n")
             sys.exit(1)
 
+    device = CONFIG['DEVICE']
+    variant = CONFIG['VARIANT']
+    error_chat = CONFIG.get('ERROR_CHAT_ID') or CONFIG['CHAT_ID']
+    official_txt = "Official" if CONFIG.get('OFFICIAL_FLAG') else "Unofficial"
+    out_dir = f"out/target/product/{device}"
+
     bot = CIBot(CONFIG)
     cpu_count = os.cpu_count()
     sync_jobs = 12 if cpu_count > 8 else cpu_count
@@ -205,18 +271,23 @@ def main():
     # 1. Disk Optimization
     if args.disk_optimization:
         io_script = os.path.expanduser("~/io.sh")
-        if os.path.exists(io_script):
-            subprocess.run(["bash", io_script])
-        else:
-            print(f"{BOLD_GREEN}Downloading and running disk optimization script...{RESET}")
-            subprocess.run("curl -s https://raw.githubusercontent.com/KanishkTheDerp/scripts/master/io.sh | bash", shell=True)
-        print(f"{BOLD_GREEN}\nDisk optimization complete.{RESET}\n")
+        try:
+            if not os.path.exists(io_script):
+                print(f"{BOLD_GREEN}Downloading disk optimization script...{RESET}")
+                r = bot.session.get("https://raw.githubusercontent.com/KanishkTheDerp/scripts/master/io.sh", timeout=30)
+                r.raise_for_status()
+                with open(io_script, "wb") as f:
+                    f.write(r.content)
+            subprocess.run(["bash", io_script], check=True)
+            print(f"{BOLD_GREEN}\nDisk optimization complete.{RESET}\n")
+        except Exception as e:
+            print(f"{RED}Disk optimization failed: {e}{RESET}")
 
     # 2. Syncing
     if args.sync:
         msg = (f"<b>Build Status: Syncing Sources</b>\n\n"
                f"<b>ROM:</b> <code>{ROM_NAME}</code>\n"
-               f"<b>Device:</b> <code>{CONFIG['DEVICE']}</code>\n"
+               f"<b>Device:</b> <code>{device}</code>\n"
                f"<b>Jobs:</b> <code>{sync_jobs} Threads</code>\n"
                f"<b>Directory:</b> <code>{ROOT_DIRECTORY}</code>")
 
@@ -235,7 +306,7 @@ def main():
             duration = format_duration(time.time() - start_sync)
             done_msg = (f"<b>Build Status: Sync Complete</b>\n\n"
                         f"<b>ROM:</b> <code>{ROM_NAME}</code>\n"
-                        f"<b>Device:</b> <code>{CONFIG['DEVICE']}</code>\n"
+                        f"<b>Device:</b> <code>{device}</code>\n"
                         f"<b>Duration:</b> <code>{duration}</code>")
             bot.edit_message(done_msg)
         else:
@@ -249,50 +320,66 @@ def main():
         shutil.rmtree("out", ignore_errors=True)
     else:
         # Remove device out dir if -c option is not provided
-        device_out = f"out/target/product/{CONFIG['DEVICE']}"
-        print(f"{BOLD_GREEN}\nCleaning device output: {device_out}{RESET}")
-        shutil.rmtree(device_out, ignore_errors=True)
+        print(f"{BOLD_GREEN}\nCleaning device output: {out_dir}{RESET}")
+        shutil.rmtree(out_dir, ignore_errors=True)
 
     # 4. Preparation
-    for f in ["out/error.log", "out/.lock", "build.log"]:
-        if os.path.exists(f):
+    for f in ("out/error.log", "out/.lock", "build.log"):
+        with suppress(FileNotFoundError):
             os.remove(f)
 
-    official_txt = "Official" if CONFIG.get('OFFICIAL_FLAG') else "Unofficial"
-    build_msg = (f"<b>Build Status: Compiling</b>\n\n"
-                 f"<b>ROM:</b> <code>{ROM_NAME}</code>\n"
-                 f"<b>Device:</b> <code>{CONFIG['DEVICE']}</code>\n"
-                 f"<b>Android:</b> <code>{ANDROID_VERSION}</code>\n"
-                 f"<b>Type:</b> <code>{official_txt}</code>\n"
-                 f"<b>Jobs:</b> <code>{cpu_count} Threads</code>\n"
-                 f"<b>Status:</b> <code>Initializing...</code>")
+    compile_prefix = (f"<b>Build Status: Compiling</b>\n\n"
+                      f"<b>ROM:</b> <code>{ROM_NAME}</code>\n"
+                      f"<b>Device:</b> <code>{device}</code>\n"
+                      f"<b>Android:</b> <code>{ANDROID_VERSION}</code>\n"
+                      f"<b>Type:</b> <code>{official_txt}</code>\n"
+                      f"<b>Jobs:</b> <code>{cpu_count} Threads</code>\n")
+    build_msg = compile_prefix + "<b>Status:</b> <code>Initializing...</code>"
 
     bot.message_id = bot.send_message(build_msg)
     start_build = time.time()
 
     print(f"{BOLD_GREEN}\nSetting up build environment and running brunch...{RESET}")
 
-    export_vars = f"export BUILD_DATETIME={build_datetime} BUILD_NUMBER={build_number}"
-    
-    build_cmd = (f"bash -c '{export_vars} && source build/envsetup.sh && {export_vars} && "
-                 f"brunch {CONFIG['DEVICE']} {CONFIG['VARIANT']}' 2>&1 | tee -a build.log")
-
-    process = subprocess.Popen(build_cmd, shell=True)
+    build_env = {**os.environ, "BUILD_DATETIME": build_datetime, "BUILD_NUMBER": build_number}
+    build_cmd = ["bash", "-c", f"source build/envsetup.sh && "
+                 f"brunch {shlex.quote(device)} {shlex.quote(variant)}"]
+
+    log_fh = open("build.log", "ab", buffering=0)
+    process = subprocess.Popen(build_cmd, stdout=log_fh, stderr=subprocess.STDOUT, env=build_env)
+
+    stop_tail = threading.Event()
+    prog_updates = queue.Queue()
+    tailer = threading.Thread(target=tail_progress, args=("build.log", stop_tail, prog_updates), daemon=True)
+    tailer.start()
+
+    current_prog = None
+    last_pct = 0
+    last_edit_ts = 0
+    while True:
+        while True:
+            try:
+                current_prog = prog_updates.get_nowait()
+            except queue.Empty:
+                break
+        # Coalesce edits to stay well clear of Telegram rate limits
+        if current_prog:
+            pct = int(current_prog.split("%", 1)[0])
+            now_ts = time.time()
+            if abs(pct - last_pct) >= 1 and now_ts - last_edit_ts >= 15:
+                prog_msg = compile_prefix + f"<b>Progress:</b> <code>{current_prog}</code>"
+                if bot.edit_message(prog_msg):
+                    last_pct = pct
+                    last_edit_ts = now_ts
+        try:
+            process.wait(timeout=10)
+            break
+        except subprocess.TimeoutExpired:
+            pass
 
-    previous_prog = ""
-    while process.poll() is None:
-        current_prog = fetch_progress("build.log")
-        if current_prog and current_prog != previous_prog:
-            prog_msg = (f"<b>Build Status: Compiling</b>\n\n"
-                        f"<b>ROM:</b> <code>{ROM_NAME}</code>\n"
-                        f"<b>Device:</b> <code>{CONFIG['DEVICE']}</code>\n"
-                        f"<b>Android:</b> <code>{ANDROID_VERSION}</code>\n"
-                        f"<b>Type:</b> <code>{official_txt}</code>\n"
-                        f"<b>Jobs:</b> <code>{cpu_count} Threads</code>\n"
-                        f"<b>Progress:</b> <code>{current_prog}</code>")
-            bot.edit_message(prog_msg)
-            previous_prog = current_prog
-        time.sleep(10)
+    log_fh.close()
+    stop_tail.set()
+    tailer.join()
 
     # 5. Post-Build
     duration = format_duration(time.time() - start_build)
@@ -301,45 +388,34 @@ def main():
 
     if os.path.exists("build.log"):
         try:
-            with open("build.log", "r", encoding="utf-8", errors="ignore") as f:
-                if "build completed successfully" in f.read():
-                    build_success = True
+            if tail_contains("build.log", "build completed successfully"):
+                build_success = True
         except Exception as e:
             print(f"{YELLOW}Warning: Could not read build.log: {e}{RESET}")
 
-    out_dir = f"out/target/product/{CONFIG['DEVICE']}"
-    if not build_success and os.path.exists(out_dir):
-         files = [f for f in os.listdir(out_dir) if CONFIG['DEVICE'] in f and f.endswith(".zip")]
-         if files:
-             print(f"{YELLOW}Log success message not found, but ZIP exists. Assuming success.{RESET}")
-             build_success = True
+    all_files = list_device_zips(out_dir, device) if os.path.isdir(out_dir) else []
+    if not build_success and all_files:
+        print(f"{YELLOW}Log success message not found, but ZIP exists. Assuming success.{RESET}")
+        build_success = True
 
     if not build_success:
         fail_msg = (f"<b>Build Status: Failed</b>\n\n"
                     f"<i>Check the attached log for details.</i>")
 
-        target_error_chat = CONFIG.get('ERROR_CHAT_ID') if CONFIG.get('ERROR_CHAT_ID') else CONFIG['CHAT_ID']
-        bot.edit_message(fail_msg, chat_id=target_error_chat)
+        bot.edit_message(fail_msg, chat_id=error_chat)
 
         if os.path.exists("out/error.log"):
-             bot.send_document("out/error.log", chat_id=target_error_chat)
+             bot.send_document("out/error.log", chat_id=error_chat)
 
         sys.exit(1)
 
     try:
-        all_files = [f for f in os.listdir(out_dir) if CONFIG['DEVICE'] in f and f.endswith(".zip")]
-
         if not all_files:
             raise FileNotFoundError("Build passed (log check), but no ZIP file found in output.")
 
-        main_files = [f for f in all_files if "ota" not in f.lower() and "target_files" not in f.lower()]
+        main_files = [f for f in all_files if "ota" not in f[0].lower() and "target_files" not in f[0].lower()]
 
-        if main_files:
-            main_files.sort(key=lambda x: os.path.getsize(os.path.join(out_dir, x)), reverse=True)
-            rom_filename = main_files[0]
-        else:
-            all_files.sort(key=lambda x: os.path.getsize(os.path.join(out_dir, x)), reverse=True)
-            rom_filename = all_files[0]
+        rom_filename = max(main_files or all_files, key=lambda f: f[1])[0]
 
         rom_zip = os.path.join(out_dir, rom_filename)
 
@@ -348,55 +424,60 @@ def main():
         initial_link = None
 
         print(f"{BOLD_GREEN}\nUploading files...{RESET}")
-        if os.path.exists(recovery_img_path):
-            recovery_link = upload_gofile(recovery_img_path)
-        else:
-            rom_folder = os.path.join(out_dir, "rom_temp")
-            os.makedirs(rom_folder, exist_ok=True)
-
-            required_imgs = ["vendor_boot.img", "boot.img", "dtbo.img"]
-            for img in required_imgs:
-                src = os.path.join(out_dir, img)
-                if os.path.exists(src):
-                    shutil.copy(src, rom_folder)
-
+        initial_zip_name = None
+        if not os.path.exists(recovery_img_path):
             board_req = CONFIG.get('INITIAL_INSTALL_ZIP_DEVICES')
             if not board_req:
-                board_req = CONFIG['DEVICE']
-
-            with open(os.path.join(rom_folder, "android-info.txt"), "w") as f:
-                f.write(f"require board={board_req}\n")
-
-            with open(os.path.join(rom_folder, "fastboot-info.txt"), "w") as f:
-                f.write("version 1\nflash boot\nflash vendor_boot\nflash dtbo\nreboot bootloader\n")
+                board_req = device
 
+            # Images barely compress, so store them as-is straight from out_dir
             initial_zip_name = rom_zip.replace(".zip", "-initial-install.zip")
-            shutil.make_archive(initial_zip_name.replace(".zip", ""), 'zip', rom_folder)
-            shutil.rmtree(rom_folder)
+            with zipfile.ZipFile(initial_zip_name, 'w', zipfile.ZIP_STORED, allowZip64=True) as z:
+                for img in ["vendor_boot.img", "boot.img", "dtbo.img"]:
+                    src = os.path.join(out_dir, img)
+                    if os.path.exists(src):
+                        z.write(src, arcname=img)
+                z.writestr("android-info.txt", f"require board={board_req}\n")
+                z.writestr("fastboot-info.txt", "version 1\nflash boot\nflash vendor_boot\nflash dtbo\nreboot bootloader\n")
 
-            initial_link = upload_gofile(initial_zip_name)
-
-        rom_link = None
         rclone_remote = CONFIG.get('RCLONE_REMOTE')
         rclone_folder = CONFIG.get('RCLONE_FOLDER')
 
-        if rclone_remote and rclone_folder:
-            rom_link = upload_rclone(rom_zip, rclone_remote, rclone_folder)
-        else:
-            rom_link = upload_gofile(rom_zip)
-
-        json_path = os.path.join(ROOT_DIRECTORY, "vendor", "ota", f"{CONFIG['DEVICE']}.json")
+        json_path = os.path.join(ROOT_DIRECTORY, "vendor", "ota", f"{device}.json")
         json_link = None
-        if os.path.exists(json_path):
-            print(f"{BOLD_GREEN}Found OTA JSON: {json_path}... Uploading.{RESET}")
-            uploaded_json = upload_gofile(json_path)
-            if "http" in str(uploaded_json):
-                json_link = uploaded_json
+
+        # Uploads are independent and network-bound, so run them side by side
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            if rclone_remote and rclone_folder:
+                f_rom = executor.submit(upload_rclone, rom_zip, rclone_remote, rclone_folder)
+            else:
+                f_rom = executor.submit(upload_gofile, rom_zip)
+
+            if initial_zip_name:
+                f_initial = executor.submit(upload_gofile, initial_zip_name)
+            else:
+                f_recovery = executor.submit(upload_gofile, recovery_img_path)
+
+            f_json = None
+            if os.path.exists(json_path):
+                print(f"{BOLD_GREEN}Found OTA JSON: {json_path}... Uploading.{RESET}")
+                f_json = executor.submit(upload_gofile, json_path)
+
+            md5 = md5sum(rom_zip)
+            size_human = format_size(os.path.getsize(rom_zip))
+
+            rom_link = f_rom.result()
+            if initial_zip_name:
+                initial_link = f_initial.result()
             else:
-                print(f"{RED}JSON upload failed: {uploaded_json}{RESET}")
+                recovery_link = f_recovery.result()
 
-        md5 = subprocess.check_output(f"md5sum {rom_zip} | awk '{{print $1}}'", shell=True).decode().strip()
-        size_human = subprocess.check_output(f"ls -sh {rom_zip} | awk '{{print $1}}'", shell=True).decode().strip()
+            if f_json:
+                uploaded_json = f_json.result()
+                if "http" in str(uploaded_json):
+                    json_link = uploaded_json
+                else:
+                    print(f"{RED}JSON upload failed: {uploaded_json}{RESET}")
 
         downloads = f"<a href=\"{rom_link}\">ROM</a>"
 
@@ -410,7 +491,7 @@ def main():
 
         success_msg = (f"<b>Build Status: Success</b>\n\n"
                        f"<b>ROM:</b> <code>{ROM_NAME}</code>\n"
-                       f"<b>Device:</b> <code>{CONFIG['DEVICE']}</code>\n"
+                       f"<b>Device:</b> <code>{device}</code>\n"
                        f"<b>Android:</b> <code>{ANDROID_VERSION}</code>\n"
                        f"<b>Type:</b> <code>{official_txt}</code>\n"
                        f"<b>Size:</b> <code>{size_human}</code>\n"